@@ -30,193 +30,285 @@ bl_info = {
 }
 
 import json
+import mmap
+import os
 import pathlib
-import struct
+
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
-import bmesh
+import numpy as np
 
 from bpy_extras.io_utils import ImportHelper
 from bpy.props import StringProperty, BoolProperty, EnumProperty
 from bpy.types import Operator
 
-from typing import Callable
+from typing import Callable, NamedTuple
+
+try:
+    # optional, considerably faster on the large MSFS glTF files
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPONENT_TYPES = {
+    5120: np.int8,
+    5121: np.uint8,
+    5122: np.int16,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32,
+    # half precision floats used by Asobo for texture coordinates
+    5131: np.float16,
+}
 
-STRUCT_INDEX = struct.Struct('H')
-STRUCT_VEC2 = struct.Struct('ee')
-STRUCT_VEC3 = struct.Struct('fff')
+ACCESSOR_TYPES = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4,
+    'MAT2': 4,
+    'MAT3': 9,
+    'MAT4': 16,
+}
 
 
-def sub_buffer_from_view(buffer, buffer_view) -> list:
-    start = buffer_view['byteOffset']
-    end = start + buffer_view['byteLength']
-    return buffer[start:end]
+class AccessorInfo(NamedTuple):
+    start: int
+    count: int
+    elements: int
+    dtype: np.dtype
+    stride: int
+    view_end: int
+
+
+def build_accessor_table(gltf) -> list:
+    buffer_views = gltf['bufferViews']
+    accessors = []
+    for accessor in gltf['accessors']:
+        buffer_view_index = accessor.get('bufferView')
+        component_type = COMPONENT_TYPES.get(accessor['componentType'])
+        elements = ACCESSOR_TYPES.get(accessor['type'])
+        if None in (buffer_view_index, component_type, elements):
+            # sparse accessors without any buffer view and unknown types are
+            # not supported, only meshes actually using them fail later on
+            accessors.append(None)
+            continue
+        buffer_view = buffer_views[buffer_view_index]
+        dtype = np.dtype(component_type)
+
+        bv_offset = buffer_view.get('byteOffset', 0)
+        accessor_offset = accessor.get('byteOffset', 0)
+        stride = buffer_view.get('byteStride', dtype.itemsize * elements)
+
+        accessors.append(AccessorInfo(
+            start=bv_offset + accessor_offset,
+            count=accessor['count'],
+            elements=elements,
+            dtype=dtype,
+            stride=stride,
+            view_end=bv_offset + buffer_view['byteLength'],
+        ))
+    return accessors
+
+
+def data_from_accessor(buffer, accessor: AccessorInfo) -> np.ndarray:
+    start, count, elements, dtype, stride, view_end = accessor
+    element_size = dtype.itemsize * elements
+
+    # the last element does not need to span the full stride
+    length = (count - 1) * stride + element_size if count else 0
+    if start + length > view_end:
+        raise ValueError('accessor exceeds its buffer view')
+
+    if stride == element_size:
+        # tightly packed data can be read as it is
+        return np.frombuffer(buffer, dtype=dtype, count=count * elements,
+                             offset=start).reshape(count, elements)
+
+    base = np.frombuffer(buffer, dtype=np.uint8, count=length, offset=start)
+    # interleaved data, copy it out so the result does not keep a strided
+    # view into the whole buffer alive
+    strided = np.lib.stride_tricks.as_strided(
+        base.view(dtype), shape=(count, elements),
+        strides=(stride, dtype.itemsize))
+    return strided.copy()
+
+
+def read_primitive(accessors, buffer, selected):
+    attributes = selected['attributes']
 
+    accessor_pos = accessors[attributes['POSITION']]
+    accessor_texcoord_0 = accessors[attributes['TEXCOORD_0']]
+    accessor_texcoord_1 = accessors[attributes['TEXCOORD_1']]
+    accessor_indices = accessors[selected['indices']]
 
-def get_start_indices(accessor, stride) -> list:
-    try:
-        start = accessor['byteOffset']
-    except KeyError:
-        start = 0
-    count = accessor['count']
-    end = start + count * stride
-    return [i for i in range(start, end, stride)]
+    indices = data_from_accessor(buffer, accessor_indices).ravel()
+    pos_values = data_from_accessor(buffer, accessor_pos)
+    texcoord_0_values = data_from_accessor(buffer, accessor_texcoord_0)
+    texcoord_1_values = data_from_accessor(buffer, accessor_texcoord_1)
 
+    return indices, pos_values, texcoord_0_values, texcoord_1_values
 
-def get_indices(accessor_indices, buffer_indices) -> list:
-    try:
-        start = accessor_indices['byteOffset']
-    except KeyError:
-        start = 0
-    end = start + accessor_indices['count'] * STRUCT_INDEX.size
-    return [
-        STRUCT_INDEX.unpack(buffer_indices[i:i + STRUCT_INDEX.size])[0]
-        for i in range(start, end, STRUCT_INDEX.size)
-    ]
 
+def as_tris(indices, pos_values, texcoord_values):
+    tri_idx = np.asarray(indices, dtype=np.int32).reshape(-1, 3)
+    return pos_values[tri_idx], texcoord_values[tri_idx]
 
-def read_primitive(gltf, buffer, selected):
-    attributes = selected['attributes']
 
-    accessor_pos = gltf['accessors'][attributes['POSITION']]
-    accessor_texcoord_0 = gltf['accessors'][attributes['TEXCOORD_0']]
-    accessor_texcoord_1 = gltf['accessors'][attributes['TEXCOORD_1']]
-    accessor_indices = gltf['accessors'][selected['indices']]
-    buffer_view_indices = gltf['bufferViews'][accessor_indices['bufferView']]
-    # TODO separate buffer views and buffers per accessor since they can
-    #  potentially be different
-    buffer_view_data = gltf['bufferViews'][accessor_pos['bufferView']]
-    buffer_indices = sub_buffer_from_view(buffer, buffer_view_indices)
-    buffer_data = sub_buffer_from_view(buffer, buffer_view_data)
-
-    indices = get_indices(accessor_indices, buffer_indices)
-
-    pos_starts = get_start_indices(
-        accessor_pos, buffer_view_data['byteStride'])
-    texcoord_0_starts = get_start_indices(
-        accessor_texcoord_0, buffer_view_data['byteStride'])
-    texcoord_1_starts = get_start_indices(
-        accessor_texcoord_1, buffer_view_data['byteStride'])
-
-    pos_values = [
-        STRUCT_VEC3.unpack(buffer_data[i:i + STRUCT_VEC3.size])
-        for i in pos_starts]
-    texcoord_0_values = [
-        STRUCT_VEC2.unpack(buffer_data[i:i + STRUCT_VEC2.size])
-        for i in texcoord_0_starts]
-    texcoord_1_values = [
-        STRUCT_VEC2.unpack(buffer_data[i:i + STRUCT_VEC2.size])
-        for i in texcoord_1_starts]
+def build_loops(idx, start_index, start_vertex, tri_count,
+                out) -> np.ndarray:
+    end_index = start_index + tri_count * 3
+    tris = idx[start_index:end_index].reshape(tri_count, 3)
+    # reversing the winding order of each triangle
+    return np.add(tris[:, ::-1], start_vertex, out=out)
 
-    return indices, pos_values, texcoord_0_values, texcoord_1_values
 
+def build_loop_uvs(texcoords, loop_verts) -> np.ndarray:
+    # gathering the half precision values first moves half the bytes, the
+    # flip needs full precision though to not lose detail close to v = 1
+    uv = texcoords[loop_verts].astype(np.float32, copy=False)
+    uv[:, 1] = 1.0 - uv[:, 1]
+    return uv
 
-def as_tris(indices, pos_values, texcoord_values):
-    triangles_indices = [
-        (indices[i], indices[i + 1], indices[i + 2])
-        for i in range(0, len(indices), 3)
-    ]
-    pos_tris = []
-    texcoord_tris = []
-    for tri_idx in triangles_indices:
-        i1, i2, i3 = tri_idx
-        pos_tris.append((pos_values[i1], pos_values[i2], pos_values[i3]))
-        texcoord_tris.append(
-            (texcoord_values[i1], texcoord_values[i2], texcoord_values[i3]))
-    return pos_tris, texcoord_tris
-
-
-def fill_mesh_data(buffer, gltf, gltf_mesh, uv0, uv1, b_mesh, mat_mapping,
-                   report):
-    idx_offset = 0
-    primitives = gltf_mesh['primitives']
-    idx, pos, tc0, tc1 = read_primitive(gltf, buffer, primitives[0])
 
-    for p in pos:
-        # converting to blender z up world
-        b_mesh.verts.new((p[0], -p[2], p[1]))
-    b_mesh.verts.ensure_lookup_table()
+class DecodedMesh(NamedTuple):
+    verts: np.ndarray
+    loop_verts: np.ndarray
+    uvs: list
+    # glTF material index and triangle count of each decoded primitive
+    primitive_materials: list
+    primitive_tri_counts: list
+    errors: list
+
 
-    for prim_idx, primitive in enumerate(primitives[0:]):
+def decode_mesh(buffer, accessors, gltf_mesh) -> DecodedMesh:
+    # only works on numpy arrays so it can run outside of the main thread
+    primitives = gltf_mesh['primitives']
+    idx, pos, tc0, tc1 = read_primitive(accessors, buffer, primitives[0])
+    idx = idx.astype(np.int32)
+
+    # converting to blender z up world
+    verts = pos[:, [0, 2, 1]].astype(np.float32, copy=False)
+    verts[:, 1] *= -1
+
+    index_ranges = []
+    primitive_materials = []
+    primitive_tri_counts = []
+    errors = []
+    for primitive in primitives:
         # TODO handle Asobo primitives with different indices
         # see skipped exceptions on a320 model for example
         try:
             asobo_data = primitive['extras']['ASOBO_primitive']
         except KeyError:
             # TODO enhance error message
-            report({'ERROR'}, "No Asobo sub primitive")
+            errors.append("No Asobo sub primitive")
             continue
 
-        try:
-            mat_index = mat_mapping[primitive['material']]
-        except KeyError:
-            mat_index = -1
-
-        try:
-            start_index = asobo_data['StartIndex']
-        except KeyError:
-            start_index = 0
+        start_index = asobo_data.get('StartIndex', 0)
+        start_vertex = asobo_data.get('BaseVertexIndex', 0)
 
+        tri_count = asobo_data['PrimitiveCount']
+        index_ranges.append((start_index, start_vertex, tri_count))
+        primitive_materials.append(primitive.get('material'))
+        primitive_tri_counts.append(tri_count)
+
+    # sized once up front, each primitive then writes its own slice
+    loop_verts = np.empty((sum(primitive_tri_counts), 3), dtype=np.int32)
+    face_start = 0
+    for start_index, start_vertex, tri_count in index_ranges:
+        face_end = face_start + tri_count
+        build_loops(idx, start_index, start_vertex, tri_count,
+                    loop_verts[face_start:face_end])
+        face_start = face_end
+    loop_verts = loop_verts.ravel()
+    uvs = [build_loop_uvs(tc0, loop_verts), build_loop_uvs(tc1, loop_verts)]
+
+    return DecodedMesh(verts, loop_verts, uvs,
+                       primitive_materials, primitive_tri_counts, errors)
+
+
+def fill_mesh_data(bl_mesh, decoded: DecodedMesh, mat_mapping):
+    verts = decoded.verts
+    loop_verts = decoded.loop_verts
+    face_materials = np.repeat(
+        np.array([mat_mapping.get(m, 0) for m in decoded.primitive_materials],
+                 dtype=np.int32),
+        decoded.primitive_tri_counts)
+    face_count = len(face_materials)
+
+    bl_mesh.vertices.add(len(verts))
+    bl_mesh.vertices.foreach_set('co', verts.ravel())
+
+    bl_mesh.loops.add(len(loop_verts))
+    bl_mesh.loops.foreach_set('vertex_index', loop_verts)
+
+    bl_mesh.polygons.add(face_count)
+    bl_mesh.polygons.foreach_set(
+        'loop_start', np.arange(0, len(loop_verts), 3, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # read only since 4.0, the sizes are derived from loop_start there
+        bl_mesh.polygons.foreach_set(
+            'loop_total', np.full(face_count, 3, dtype=np.int32))
+    bl_mesh.polygons.foreach_set('material_index', face_materials)
+
+    for uv in decoded.uvs:
+        uv_layer = bl_mesh.uv_layers.new()
+        uv_layer.data.foreach_set('uv', uv.ravel())
+
+
+def create_meshes(buffer, gltf, accessors, materials, report):
+    gltf_meshes = gltf['meshes']
+
+    def decode(gltf_mesh):
+        # exceptions are handed back to be reported from the main thread
         try:
-            start_vertex = asobo_data['BaseVertexIndex']
-        except KeyError:
-            start_vertex = 0
+            return decode_mesh(buffer, accessors, gltf_mesh), None
+        except Exception as exc:
+            return None, repr(exc)
 
-        tri_count = asobo_data['PrimitiveCount']
-        for tri_i in range(tri_count):
-            i = start_index + tri_i * 3
-            face_indices = (
-                idx_offset + start_vertex + idx[i + 2],
-                idx_offset + start_vertex + idx[i + 1],
-                idx_offset + start_vertex + idx[i + 0],
-            )
-            face = b_mesh.faces.new((
-                b_mesh.verts[face_indices[0]],
-                b_mesh.verts[face_indices[1]],
-                b_mesh.verts[face_indices[2]],
-            ))
-            face.material_index = mat_index
-            for i, loop in enumerate(face.loops):
-                u, v = tc0[face_indices[i]]
-                loop[uv0].uv = (u, 1 - v)
-                u, v = tc1[face_indices[i]]
-                loop[uv1].uv = (u, 1 - v)
-
-
-def create_meshes(buffer, gltf, materials, report):
     meshes = []
-    for gltf_mesh in gltf['meshes']:
-        bl_mesh = bpy.data.meshes.new(gltf_mesh['name'])
-        meshes.append(bl_mesh)
-
-        mat_mapping = {}
-        material_count = 0
-        for primitive in gltf_mesh['primitives']:
-            gltf_mat_index = primitive['material']
-            material = materials[gltf_mat_index]
-            mesh_mat_index = bl_mesh.materials.find(material.name)
-            if mesh_mat_index > -1:
-                mat_mapping[gltf_mat_index] = mesh_mat_index
-            else:
-                mat_mapping[gltf_mat_index] = material_count
-                bl_mesh.materials.append(material)
-                material_count += 1
-
-        b_mesh = bmesh.new()
-        uv0 = b_mesh.loops.layers.uv.new()
-        uv1 = b_mesh.loops.layers.uv.new()
-
-        try:
-            fill_mesh_data(buffer, gltf, gltf_mesh, uv0, uv1, b_mesh,
-                           mat_mapping,
-                           report)
-        except Exception:
+    # decoding is plain numpy work and runs in parallel, while everything
+    # touching blender data stays on the main thread
+    with ThreadPoolExecutor() as executor:
+        decoded_meshes = executor.map(decode, gltf_meshes)
+        for gltf_mesh, (decoded, error) in zip(gltf_meshes, decoded_meshes):
             mesh_name = gltf_mesh['name']
-            report({'ERROR'}, f'could not handle mesh "{mesh_name}"')
-            continue
+            bl_mesh = bpy.data.meshes.new(mesh_name)
+            meshes.append(bl_mesh)
+
+            mat_mapping = {}
+            name_to_idx = {}
+            for primitive in gltf_mesh['primitives']:
+                gltf_mat_index = primitive.get('material')
+                if gltf_mat_index is None:
+                    # faces of primitives without material use slot 0
+                    continue
+                material = materials[gltf_mat_index]
+                mesh_mat_index = name_to_idx.get(material.name)
+                if mesh_mat_index is None:
+                    mesh_mat_index = len(name_to_idx)
+                    bl_mesh.materials.append(material)
+                    name_to_idx[material.name] = mesh_mat_index
+                mat_mapping[gltf_mat_index] = mesh_mat_index
 
-        b_mesh.to_mesh(bl_mesh)
-        bl_mesh.update()
+            if decoded is None:
+                report({'ERROR'},
+                       f'could not handle mesh "{mesh_name}": {error}')
+                continue
+
+            for message in decoded.errors:
+                report({'ERROR'}, message)
+
+            try:
+                fill_mesh_data(bl_mesh, decoded, mat_mapping)
+                # clean up degenerate and duplicate faces of broken primitives
+                bl_mesh.validate()
+                bl_mesh.update()
+            except Exception as exc:
+                report({'ERROR'},
+                       f'could not handle mesh "{mesh_name}": {exc!r}')
     return meshes
 
 
@@ -224,10 +316,11 @@ def create_objects(nodes, meshes):
     objects = []
     for node in nodes:
         name = node['name']
-        try:
-            mesh = meshes[node['mesh']]
-        except KeyError:
+        mesh_index = node.get('mesh')
+        if mesh_index is None:
             mesh = bpy.data.meshes.new(name)
+        else:
+            mesh = meshes[mesh_index]
 
         obj = bpy.data.objects.new(name, mesh)
 
@@ -252,11 +345,31 @@ def load_gltf_file(gltf_file_name):
     gltf_file_path = pathlib.Path(gltf_file_name)
     bin_file_name = gltf_file_path.with_suffix('.bin')
 
-    with open(gltf_file_path, 'r') as handle:
-        gltf = json.load(handle)
+    if orjson is not None:
+        gltf = orjson.loads(gltf_file_path.read_bytes())
+    else:
+        with open(gltf_file_path, 'rb') as handle:
+            gltf = json.load(handle)
 
-    with open(bin_file_name, 'rb') as handle:
-        buffer = handle.read()
+    # mapping the buffer instead of reading it, accessors are decoded
+    # straight from the mapped pages without a copy of the whole file
+    fd = os.open(bin_file_name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if os.fstat(fd).st_size == 0:
+            # empty files cannot be mapped
+            return gltf, b''
+        buffer = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        # the mapping stays valid once the descriptor is closed
+        os.close(fd)
+
+    # accessors are mostly decoded front to back, let the kernel read ahead
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        try:
+            buffer.madvise(mmap.MADV_SEQUENTIAL)
+            buffer.madvise(mmap.MADV_WILLNEED)
+        except (OSError, AttributeError):
+            pass
 
     return gltf, buffer
 
@@ -274,31 +387,29 @@ def setup_object_hierarchy(bl_objects, gltf, collection):
     scene_description = gltf['scenes'][0]
     gltf_nodes = gltf['nodes']
 
-    def add_children(bl_parent_object, gltf_parent_node):
-        try:
-            gltf_children = gltf_parent_node['children']
-        except KeyError:
-            return
-
-        for j in gltf_children:
-            gltf_child_node = gltf_nodes[j]
-            bl_child_object = bl_objects[j]
-            bl_child_object.parent = bl_parent_object
-            collection.objects.link(bl_child_object)
-            add_children(bl_child_object, gltf_child_node)
-
-    for i in scene_description['nodes']:
-        gltf_node = gltf_nodes[i]
-        bl_object = bl_objects[i]
+    # depth first walk with an explicit stack so deep hierarchies cannot run
+    # into the recursion limit
+    stack = [(i, None) for i in reversed(scene_description['nodes'])]
+    while stack:
+        j, bl_parent_object = stack.pop()
+        bl_object = bl_objects[j]
+        if bl_parent_object is not None:
+            bl_object.parent = bl_parent_object
         collection.objects.link(bl_object)
-        add_children(bl_object, gltf_node)
+        children = gltf_nodes[j].get('children', ())
+        stack.extend((c, bl_object) for c in reversed(children))
 
 
 def import_msfs_gltf(context, gltf_file: str, report: Callable):
     gltf, buffer = load_gltf_file(gltf_file)
 
+    accessors = build_accessor_table(gltf)
     materials = create_materials(gltf)
-    meshes = create_meshes(buffer, gltf, materials, report)
+    try:
+        meshes = create_meshes(buffer, gltf, accessors, materials, report)
+    finally:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
     objects = create_objects(gltf['nodes'], meshes)
     setup_object_hierarchy(objects, gltf, context.collection)
 